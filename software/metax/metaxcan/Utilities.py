@@ -2,12 +2,12 @@ import logging
 import pandas
 import os
 import numpy
-from scipy import stats
+from scipy.special import erfc
 
 from .. import Constants
 from .. import Utilities
 from .. import MatrixManager
-from ..PredictionModel import WDBQF, WDBEQF, load_model, dataframe_from_weight_data
+from ..PredictionModel import WDBQF, WDBEQF, load_model
 from ..misc import DataFrameStreamer
 from . import AssociationCalculation
 
@@ -16,11 +16,13 @@ class SimpleContext(AssociationCalculation.Context):
         self.gwas = gwas
         self.model = model
         self.covariance = covariance
+        self._weights_by_gene = {g: w for g, w in model.weights.groupby(WDBQF.K_GENE, sort=False)}
+        self._gwas_by_snp = gwas.drop_duplicates(Constants.SNP, keep="last").set_index(Constants.SNP, drop=False).rename_axis(None)
 
     def get_weights(self, gene):
-        w = self.model.weights
-        w = w[w.gene == gene]
-        return w
+        if not gene in self._weights_by_gene:
+            return self.model.weights.iloc[0:0]
+        return self._weights_by_gene[gene]
 
     def get_covariance(self, gene, snps):
         return self.covariance.get(gene, snps, strict_whitelist=False)
@@ -30,8 +32,8 @@ class SimpleContext(AssociationCalculation.Context):
         return self.covariance.n_ids(gene)
 
     def get_gwas(self, snps):
-        g = self.gwas
-        g = g[g[Constants.SNP].isin(snps)]
+        g = self._gwas_by_snp.reindex(snps)
+        g = g.dropna(subset=[Constants.ZSCORE]).reset_index(drop=True)
         return g
 
     def get_model_snps(self):
@@ -45,99 +47,100 @@ class SimpleContext(AssociationCalculation.Context):
         gwas = self.get_gwas(w[WDBQF.K_RSID].values)
 
         i = pandas.merge(w, gwas, left_on="rsid", right_on="snp")
-        if not Constants.BETA in i: i[Constants.BETA] = None
+        if not Constants.BETA in i: i[Constants.BETA] = numpy.nan
         i = i[[Constants.SNP, WDBQF.K_WEIGHT, Constants.ZSCORE, Constants.BETA]]
 
-        snps, cov = self.get_covariance(gene, i[Constants.SNP].values)
+        snps, cov = self.get_covariance(gene, set(i[Constants.SNP]))
 
         # fast subsetting and aligning
-        d_columns = i.columns.values
         if snps is not None and len(snps):
-            d = {x[0]: x for x in i.values}
-            d = [d[snp] for snp in snps]
-            d = list(zip(*d))
-            d = {d_columns[i]:d[i] for i in range(0, len(d_columns))}
-            i = pandas.DataFrame(d)
+            position = pandas.Series(numpy.arange(len(i)), index=i[Constants.SNP].values)
+            # a snp listed twice for a gene keeps its last row
+            position = position[~position.index.duplicated(keep="last")]
+            position = position.reindex(snps).dropna().astype(int).values
+            i = i.iloc[position]
+            i = {k: i[k].values for k in i}
         else:
-            i = pandas.DataFrame(columns=d_columns)
+            i = _empty_calculation_data()
         return len(w.weight), i, cov, snps
 
     def get_model_info(self):
         return self.model.extra
 
+def _empty_calculation_data():
+    d = {Constants.SNP: numpy.empty(0, dtype=object),
+         WDBQF.K_WEIGHT: numpy.empty(0, dtype=numpy.float64),
+         Constants.ZSCORE: numpy.empty(0, dtype=numpy.float64),
+         Constants.BETA: numpy.empty(0, dtype=numpy.float64)}
+    for v in d.values():
+        v.setflags(write=False)
+    return d
+
 class OptimizedContext(SimpleContext):
+    # handed out as is for every gene without usable data, so its arrays are read only.
+    _EMPTY = _empty_calculation_data()
+
     def __init__(self, gwas, model, covariance, MAX_R):
         self.covariance = covariance
-        self.genes, self.weight_data, self.snps_in_model = _prepare_weight_data(model, MAX_R)
-        self.gwas_data = _prepare_gwas_data(gwas)
+        self.genes, self.weights, self.weight_slices = _prepare_weight_data(model, MAX_R)
+        self.gwas_snps, self.gwas_index, self.gwas_zscore, self.gwas_beta = _prepare_gwas_data(gwas)
+        self.weight_rsids, self.weight_values, self.weight_gwas_rows = _prepare_weight_arrays(self.weights, self.gwas_snps, self.gwas_index)
+        self.weights[WDBQF.K_RSID] = self.weight_rsids
+        self.snps_in_model = set(self.weight_rsids)
         self.extra = model.extra
-        self.last_gene = None
         self.data_cache = None
         self.pedantic = MAX_R is None
 
-    def _get_weights(self, gene):
-        w = self.weight_data[gene]
-        w = {x[WDBQF.RSID]:x[WDBQF.WEIGHT] for x in w}
-        return w
-
     def get_weights(self, gene):
-        w = self.weight_data[gene]
-        w = dataframe_from_weight_data(list(zip(*w)))
+        w = self.weights.iloc[self.weight_slices[gene]]
         return w
 
     def get_model_snps(self):
         return set(self.snps_in_model)
 
-    def _get_gwas(self, snps):
-        snps = set(snps)
-        g = self.gwas_data
-        g = [g[x] for x in snps if x in g]
-        g = {x[0]:(x[1], x[2]) for x in g}
-        return g
-
     def get_gwas(self, snps):
-        snps = set(snps)
-        g = self.gwas_data
-        g = [g[x] for x in snps if x in g]
-        if len(g):
-            g = list(zip(*g))
-            g = pandas.DataFrame({Constants.SNP:g[0], Constants.ZSCORE:g[1], Constants.BETA:g[2]})
-        else:
-            g = pandas.DataFrame(columns=[Constants.SNP, Constants.ZSCORE, Constants.BETA])
+        snps = list(self.gwas_index.keys() & snps)
+        i = list(map(self.gwas_index.__getitem__, snps))
+        g = pandas.DataFrame({Constants.SNP:snps, Constants.ZSCORE:self.gwas_zscore[i], Constants.BETA:self.gwas_beta[i]},
+                             columns=[Constants.SNP, Constants.ZSCORE, Constants.BETA])
         return g
 
     def get_data_intersection(self):
-        return _data_intersection_3(self.weight_data, self.gwas_data, self.extra.gene.values, self.pedantic)
+        return _data_intersection_3(self.weight_slices, self.weight_rsids, self.gwas_index, self.extra.gene.values, self.pedantic)
 
     def provide_calculation(self, gene):
-        if gene != self.last_gene:
-            #dummy while(True) to emulate go/to
-            while True:
-                w = self._get_weights(gene)
-                gwas = self._get_gwas(list(w.keys()))
-                type = [numpy.str, numpy.float64, numpy.float64, numpy.float64]
-                columns = [Constants.SNP, WDBQF.K_WEIGHT, Constants.ZSCORE, Constants.BETA]
-                d = {x: v for x, v in w.items() if x in gwas}
-
-                snps, cov = self.get_covariance(gene, list(d.keys()))
-                if snps is None:
-                    d = pandas.DataFrame(columns=columns)
-                    self.data_cache = len(w), d, cov, snps
-                    self.last_gene = gene
-                    break
-
-                d = [(x, w[x], gwas[x][0], gwas[x][1]) for x in snps]
-                d = list(zip(*d))
-                if len(d):
-                    d = {columns[i]:numpy.array(d[i], dtype=type[i]) for i in range(0,len(columns))}
-                else:
-                    d = {columns[i]:numpy.array([]) for i in range(0,len(columns))}
-
-                self.data_cache = len(w), d, cov, snps
-                self.last_gene = gene
-                break
-
-        return self.data_cache
+        # gene and data are swapped in together, so concurrent callers never see a mismatched pair
+        cache = self.data_cache
+        if cache is None or cache[0] != gene:
+            cache = (gene, self._provide_calculation(gene))
+            self.data_cache = cache
+        return cache[1]
+
+    def _provide_calculation(self, gene):
+        k = self.weight_slices[gene]
+        rsids = self.weight_rsids[k]
+        weights = self.weight_values[k]
+        rows = self.weight_gwas_rows[k]
+        n = len(rsids)
+
+        present = numpy.flatnonzero(rows > -1)
+        if not len(present):
+            return n, self._EMPTY, None, None
+
+        # doubles as the covariance whitelist, and as the map to realign to the covariance's snp order
+        position = {x:i for x,i in zip(rsids[present].tolist(), present.tolist())}
+        snps, cov = self.get_covariance(gene, position)
+        if snps is None:
+            return n, self._EMPTY, cov, snps
+
+        # a single gather per column, straight into its final dtype
+        i = numpy.fromiter((position[x] for x in snps), dtype=numpy.int64, count=len(snps))
+        rows = rows[i]
+        d = {Constants.SNP: rsids[i],
+             WDBQF.K_WEIGHT: weights[i],
+             Constants.ZSCORE: self.gwas_zscore[rows],
+             Constants.BETA: self.gwas_beta[rows]}
+        return n, d, cov, snps
 
     def get_model_info(self):
         return self.extra
@@ -145,59 +148,55 @@ class OptimizedContext(SimpleContext):
 
 def _data_intersection(model, gwas):
     weights = model.weights
-    k = pandas.merge(weights, gwas, how='inner', left_on="rsid", right_on="snp")
-    genes = k.gene.drop_duplicates().values
-    snps = k.rsid.drop_duplicates().values
+    i = weights[WDBQF.K_RSID].isin(gwas[Constants.SNP].values).values
+    genes = weights[WDBQF.K_GENE][i].drop_duplicates().values
+    snps = pandas.unique(weights[WDBQF.K_RSID].values[i])
     return genes, snps
 
-def _data_intersection_2(weight_data, gwas_data):
+def _data_intersection_2(weight_slices, weight_rsids, gwas_data):
     genes = set()
     snps = set()
-    for gene, entries in weight_data.items():
-        gs = list(zip(*entries))[WDBQF.RSID]
-        for s in gs:
-            if s in gwas_data:
-                genes.add(gene)
-                snps.add(s)
+    gwas_snps = set(gwas_data)
+    for gene, k in weight_slices.items():
+        hits = gwas_snps.intersection(weight_rsids[k].tolist())
+        if hits:
+            genes.add(gene)
+            snps.update(hits)
     return genes, snps
 
-def _data_intersection_3(weight_data, gwas_data, gene_list, pedantic):
+def _data_intersection_3(weight_slices, weight_rsids, gwas_data, gene_list, pedantic):
     genes = list()
     _genes = set()
     snps =set()
+    gwas_snps = set(gwas_data)
     for gene in gene_list:
-        if not gene in weight_data:
+        if not gene in weight_slices:
             if pedantic:
                 logging.warning("Issues processing gene %s, skipped", gene)
             continue
-        gs = list(zip(*weight_data[gene]))[WDBQF.RSID]
-        for s in gs:
-            if s in gwas_data:
-                if not gene in _genes:
-                    _genes.add(gene)
-                    genes.append(gene)
-                snps.add(s)
+        hits = gwas_snps.intersection(weight_rsids[weight_slices[gene]].tolist())
+        if hits:
+            if not gene in _genes:
+                _genes.add(gene)
+                genes.append(gene)
+            snps.update(hits)
 
     return genes, snps
 
 def _sanitized_gwas(gwas):
     gwas = gwas[[Constants.SNP, Constants.ZSCORE, Constants.BETA]]
-    if numpy.any(~ numpy.isfinite(gwas[Constants.ZSCORE])):
+    finite = numpy.isfinite(gwas[Constants.ZSCORE].values)
+    if not finite.all():
         logging.warning("Discarding non finite GWAS zscores")
-        gwas = gwas.loc[numpy.isfinite(gwas[Constants.ZSCORE])]
+        gwas = gwas.iloc[finite]
     return gwas
 
 def _prepare_gwas(gwas):
     #If zscore is numeric, then everything is fine with us.
-    # if not, try to remove "NA" strings.
-    try:
-        i = gwas.zscore.apply(lambda x: x != "NA")
-        gwas = gwas.loc[i]
-        gwas = pandas.DataFrame(gwas)
-        gwas = gwas.assign(**{Constants.ZSCORE:gwas.zscore.astype(numpy.float64)})
-    except Exception as e:
-        logging.info("Unexpected issue preparing gwas... %s", str(e))
-        pass
+    # if not, remove "NA" strings, and anything else that doesn't read as a number becomes NaN.
+    if gwas[Constants.ZSCORE].dtype == object:
+        gwas = gwas.loc[(gwas[Constants.ZSCORE] != "NA").values]
+        gwas = gwas.assign(**{Constants.ZSCORE:pandas.to_numeric(gwas[Constants.ZSCORE], errors="coerce")})
 
     if not Constants.BETA in gwas:
         gwas = gwas.assign(**{Constants.BETA: numpy.nan})
@@ -205,10 +204,12 @@ def _prepare_gwas(gwas):
     return gwas
 
 def _prepare_gwas_data(gwas):
-    data = {}
-    for x in gwas.values:
-        data[x[0]] = x
-    return data
+    """Returns the snp column, a snp -> row index mapping, and the zscore and beta columns as arrays addressed by it."""
+    snp = gwas[Constants.SNP].values
+    index = dict(zip(snp.tolist(), range(len(snp))))
+    zscore = gwas[Constants.ZSCORE].values.astype(numpy.float64)
+    beta = gwas[Constants.BETA].values.astype(numpy.float64)
+    return snp, index, zscore, beta
 
 def _prepare_model(model):
     K = WDBQF.K_GENE
@@ -217,30 +218,53 @@ def _prepare_model(model):
     return model
 
 def _prepare_weight_data(model, MAX_R=None):
-    d,_d = [],{}
-    snps = set()
-    for x in model.weights.values:
-        if MAX_R and len(d) + 1 > MAX_R:
-            logging.info("Restricting data load to first %d", MAX_R)
-            break
-        gene = x[WDBQF.GENE]
-        if not gene in d:
-            _d[gene] = []
-            d.append(gene)
-        entries = _d[gene]
-        entries.append(x)
-        snps.add(x[WDBQF.RSID])
-    return d, _d, snps
+    """Returns the weights sorted so that each gene's rows are contiguous, and a gene -> slice mapping into them."""
+    weights = model.weights
+    d = weights[WDBQF.K_GENE].drop_duplicates().dropna().values
+    if MAX_R and len(d) > MAX_R:
+        logging.info("Restricting data load to first %d", MAX_R)
+        d = d[:MAX_R]
+        weights = weights[weights[WDBQF.K_GENE].isin(d)]
+    # genes keep their order of appearance, and a stable sort keeps each gene's rows in model order.
+    # Rows without a gene get code -1, sort first, and are left out of every slice.
+    codes = pandas.Categorical(weights[WDBQF.K_GENE], d).codes
+    order = numpy.argsort(codes, kind="mergesort")
+    weights = weights.iloc[order].reset_index(drop=True)
+    bounds = numpy.searchsorted(codes[order], numpy.arange(len(d)+1))
+    slices = {gene: slice(bounds[i], bounds[i+1]) for i, gene in enumerate(d)}
+    return list(d), weights, slices
+
+def _prepare_weight_arrays(weights, gwas_snps, gwas_index):
+    """Returns the rsid and weight columns as arrays, plus every rsid encoded as its gwas row (-1 when absent).
+    Rsids are interned: each snp is held by a single str object, the gwas' own when it has one.
+    Missing rsids are kept as they are, and never match a gwas row."""
+    original = weights[WDBQF.K_RSID].values
+    codes, unique = pandas.factorize(original)
+    unique = numpy.array(unique, dtype=object)
+    unique_rows = numpy.fromiter((gwas_index.get(x, -1) for x in unique), dtype=numpy.int32, count=len(unique))
+    in_gwas = unique_rows > -1
+    unique[in_gwas] = gwas_snps[unique_rows[in_gwas]]
+
+    # factorize codes missing values as -1, which must not be used as an index
+    present = codes > -1
+    rsids = numpy.array(original, dtype=object)
+    rsids[present] = unique[codes[present]]
+    rows = numpy.full(len(codes), -1, dtype=numpy.int32)
+    rows[present] = unique_rows[codes[present]]
+    values = weights[WDBQF.K_WEIGHT].values.astype(numpy.float64)
+    return rsids, values, rows
 
 def _beta_loader(args):
     beta_contents = Utilities.contentsWithPatternsFromFolder(args.beta_folder, [])
-    r = pandas.DataFrame()
+    r = []
     for beta_name in beta_contents:
         logging.info("Processing %s", beta_name)
         beta_path = os.path.join(args.beta_folder, beta_name)
         b = pandas.read_table(beta_path)
-        r = pandas.concat([r, b])
-    return r
+        r.append(b)
+    if not len(r):
+        return pandas.DataFrame()
+    return pandas.concat(r, ignore_index=True, copy=False)
 
 def _gwas_wrapper(gwas):
     logging.info("Processing loaded gwas")
@@ -282,14 +306,6 @@ def _build_simple_context(model, covariance_manager, gwas):
     context = SimpleContext(gwas, model, covariance_manager)
     return context
 
-def _to_int(d):
-    r = d
-    try:
-        r = int(d)
-    except:
-        pass
-    return r
-
 def _results_column_order(with_additional=False):
     K = Constants
     AK = AssociationCalculation.ARF
@@ -311,36 +327,41 @@ def _results_column_order(with_additional=False):
 
     return column_order
 
+def _remove_ens_version(genes):
+    return numpy.array([x.partition(".")[0] for x in genes], dtype=object)
+
 def format_output(results, context, remove_ens_version):
     results = results.drop("n_snps_in_model",1)
 
-    # Dodge the use of cdf on non finite values
-    i = numpy.isfinite(results.zscore)
-    results[Constants.PVALUE] = numpy.nan
-    results.loc[i, Constants.PVALUE] = 2 * stats.norm.sf(numpy.abs(results.loc[i, Constants.ZSCORE].values))
+    # Dodge the use of cdf on non finite values.
+    # 2*norm.sf(|z|) == erfc(|z|/sqrt(2)), straight from the ufunc instead of through scipy.stats
+    z = results[Constants.ZSCORE].values.astype(numpy.float64)
+    i = numpy.isfinite(z)
+    p = numpy.full(z.shape, numpy.nan)
+    p[i] = erfc(numpy.abs(z[i]) / numpy.sqrt(2))
+    results[Constants.PVALUE] = p
 
     model_info = pandas.DataFrame(context.get_model_info())
 
     merged = pandas.merge(results, model_info, how="inner", on="gene")
     if remove_ens_version:
-        merged.gene = merged.gene.str.split(".").str.get(0)
+        merged[WDBQF.K_GENE] = _remove_ens_version(merged[WDBQF.K_GENE].values)
 
 
     column_order = _results_column_order()
     merged = merged[column_order]
 
-    # since we allow NA in covs, we massage it a little bit into resemblying an int instead of a float
-    # (pandas uses the NaN float.)
-
-    merged.n_snps_in_cov = merged.n_snps_in_cov.apply(_to_int)
+    # since we allow NA in covs, we use pandas' nullable integer instead of the NaN float.
+    # Missing values stay as NaN in memory; they are written as "NA" when saving.
+    n_snps_in_cov = pandas.to_numeric(merged.n_snps_in_cov, errors="coerce")
+    merged[AssociationCalculation.ARF.K_N_SNPS_IN_COV] = n_snps_in_cov.astype("Int64")
     merged = merged.sort_values(by=Constants.PVALUE)
-    merged = merged.fillna("NA")
     return merged
 
 def merge_additional_output(results, stats, context, remove_ens_version):
     merged = pandas.merge(results, stats, how="inner", on="gene")
     if remove_ens_version:
-        merged.gene = merged.gene.str.split(".").str.get(0)
+        merged[WDBQF.K_GENE] = _remove_ens_version(merged[WDBQF.K_GENE].values)
 
     column_order = _results_column_order(with_additional=True)
     merged = merged[column_order]
@@ -29,7 +29,7 @@ setuptools.setup(name="MetaXcan",
                             'MulTiXcan.py',
                             'SMulTiXcan.py'],
                  description=["TBD"],
-                 install_requires=['scipy>=1.2.2,<1.3', 'numpy>=1.14.2', 'pandas>=0.22.0', 'patsy>=0.5.0',
+                 install_requires=['scipy>=1.2.2,<1.3', 'numpy>=1.14.2', 'pandas>=0.24.0', 'patsy>=0.5.0',
                                    'statsmodels>=0.10.0', 'h5py>=2.7.1', 'h5py-cache>=1.0', 'bgen_reader>=3.0.3', 'cyvcf2>=0.8.0'],
                  long_description=read('Readme.md'),
                  keywords=['TBD'],
@@ -1,9 +1,11 @@
 import numpy
 import numpy.testing
+import pandas
 
 import unittest
 from . import SampleData
 from metax import PredictionModel
+from metax import Constants
 from metax import MatrixManager
 D = MatrixManager.GENE_SNP_COVARIANCE_DEFINITION
 
@@ -29,6 +31,14 @@ def _context():
     c = Utilities._build_context(model, covariance, gwas)
     return c
 
+def _simple_context():
+    gwas = _gwas()
+    model = _prediction_model()
+    s = SampleData.dataframe_from_covariance(SampleData.sample_covariance_s_1())
+    covariance = MatrixManager.MatrixManager(s, D)
+    c = Utilities._build_simple_context(model, covariance, gwas)
+    return c
+
 def assert_equal_tuple(test, a, b):
     test.assertEqual(a[0], b[0])
     numpy.testing.assert_allclose(a[1], b[1])
@@ -52,6 +62,16 @@ class TestAssociationCalculation(unittest.TestCase):
         self.assertEqual(set(s), set(['rs3', 'rs6', 'rs7', 'rs7666', 'rs8', 'rs9']))
         self.assertEqual(set(g), set(["B"]))
 
+    def test_prepare_gwas(self):
+        gwas = SampleData.dataframe_from_gwas(SampleData.sample_gwas_data_4())[:4]
+        gwas = gwas.assign(zscore=["0.3", "NA", "0.5", "x"])
+        gwas = Utilities._prepare_gwas(gwas)
+        self.assertEqual(list(gwas.snp), ["rs1666", "rs2", "rs3"])
+        numpy.testing.assert_allclose(gwas.zscore, [0.3, 0.5, numpy.nan])
+
+        gwas = Utilities._sanitized_gwas(gwas)
+        self.assertEqual(list(gwas.snp), ["rs1666", "rs2"])
+
     def test_build_context(self):
         c = _context()
         r, snps = AssociationCalculation.association("A", c, return_snps=True)
@@ -76,6 +96,101 @@ class TestAssociationCalculation(unittest.TestCase):
         r, snps = AssociationCalculation.association("G", c, return_snps=True)
         assert_equal_tuple(self, r, ('G', numpy.nan, numpy.nan, 0, 1, 1, 1))
 
+    def test_build_context_max_r(self):
+        s = SampleData.dataframe_from_covariance(SampleData.sample_covariance_s_1())
+        c = Utilities._build_context(_prediction_model(), MatrixManager.MatrixManager(s, D), _gwas(), MAX_R=3)
+
+        # the first MAX_R genes are loaded, each with all of its rows
+        self.assertEqual(c.genes, ["A", "B", "C"])
+        self.assertEqual(list(c.weights.gene), ["A"]*4 + ["B"]*6 + ["C"]*3)
+        self.assertEqual(list(c.get_weights("C").rsid), ["rs100", "rs101", "rs102"])
+        self.assertFalse("D" in c.weight_slices)
+
+        genes, snps = c.get_data_intersection()
+        self.assertEqual(genes, ["A", "B", "C"])
+
+        r = AssociationCalculation.association("C", c)
+        assert_equal_tuple(self, r, ('C', 0.089999999999999983, 0.049999999999999989, 0.013333333333320003, 3, 2, 1))
+
+    def test_provide_calculation(self):
+        c = _context()
+        n, d, cov, snps = c.provide_calculation("C")
+        self.assertEqual(n, 3)
+        self.assertEqual(snps, ["rs101"])
+        self.assertEqual(d["snp"].dtype, object)
+        numpy.testing.assert_array_equal(d["snp"], ["rs101"])
+        for k, v in [("weight", 0.2), ("zscore", 0.09), ("beta", 0.01)]:
+            self.assertEqual(d[k].dtype, numpy.float64)
+            numpy.testing.assert_allclose(d[k], [v])
+
+        n, d, cov, snps = c.provide_calculation("E")
+        self.assertEqual(n, 1)
+        self.assertEqual(snps, None)
+        self.assertEqual(len(d["snp"]), 0)
+        for v in d.values():
+            self.assertFalse(v.flags.writeable)
+
+    def test_missing_rsid(self):
+        w = pandas.DataFrame({"rsid":["rs1", "rs3", None], "gene":"A", "weight":[1.0, 0.5, 5.0], "non_effect_allele":"G", "effect_allele":"A"})
+        e = SampleData.dataframe_from_extra(SampleData.sample_extra_1()[:1])
+        gwas = pandas.DataFrame({"snp":["rs1", "rs3"], "zscore":[2.0, 1.0], "beta":[0.2, 0.1]})
+        s = pandas.DataFrame({"GENE":"A", "RSID1":["rs1", "rs1", "rs3"], "RSID2":["rs1", "rs3", "rs3"], "VALUE":[1.0, 0.0, 1.0]})
+        c = Utilities._build_context(PredictionModel.Model(w, e), MatrixManager.MatrixManager(s, D), gwas)
+
+        self.assertEqual(list(c.weight_gwas_rows), [0, 1, -1])
+        self.assertTrue(c.weights.rsid.isnull().values[2])
+        self.assertFalse("rs3" in list(c.weights.rsid.values[2:]))
+
+        r = AssociationCalculation.association("A", c)
+        assert_equal_tuple(self, r, ('A', 2.5/numpy.sqrt(1.25), 2.5*0.1/1.25, 1.25, 3, 2, 2))
+
+    def test_missing_gene(self):
+        w = pandas.DataFrame({"rsid":["rs1", "rs2", "rs3"], "gene":["A", None, "A"], "weight":[1.0, 3.0, 0.5], "non_effect_allele":"G", "effect_allele":"A"})
+        e = SampleData.dataframe_from_extra(SampleData.sample_extra_1()[:1])
+        gwas = pandas.DataFrame({"snp":["rs1", "rs2", "rs3"], "zscore":[2.0, 1.0, 1.0], "beta":[0.2, 0.1, 0.1]})
+        s = pandas.DataFrame({"GENE":"A", "RSID1":["rs1", "rs1", "rs3"], "RSID2":["rs1", "rs3", "rs3"], "VALUE":[1.0, 0.0, 1.0]})
+        c = Utilities._build_context(PredictionModel.Model(w, e), MatrixManager.MatrixManager(s, D), gwas)
+
+        self.assertEqual(c.genes, ["A"])
+        self.assertEqual(list(c.get_weights("A").rsid), ["rs1", "rs3"])
+
+        genes, snps = c.get_data_intersection()
+        self.assertEqual(genes, ["A"])
+
+        r = AssociationCalculation.association("A", c)
+        assert_equal_tuple(self, r, ('A', 2.5/numpy.sqrt(1.25), 2.5*0.1/1.25, 1.25, 2, 2, 2))
+
+    def test_build_simple_context(self):
+        c = _simple_context()
+        r = AssociationCalculation.association("A", c)
+        assert_equal_tuple(self, r, ('A', 0.42313735862217716, 0.42845528455235105, 0.10250000000002803, 4, 4, 3))
+
+        r = AssociationCalculation.association("B", c)
+        assert_equal_tuple(self, r, ('B', 1.904102672555114, 1.4285714285708686, 0.16333333333323405, 6, 6, 6))
+
+        r = AssociationCalculation.association("D", c)
+        assert_equal_tuple(self, r, ('D', numpy.nan, numpy.nan, numpy.nan, 2, numpy.nan, 0))
+
+        # a gene listing the same rsid twice keeps its last row, as the optimized context does
+        def _model():
+            p = _prediction_model()
+            p.weights = pandas.concat([p.weights, SampleData.dataframe_from_weights([("rs1", "A", 0.3, "T", "C")])], ignore_index=True)
+            return p
+        s = SampleData.dataframe_from_covariance(SampleData.sample_covariance_s_1())
+        c = Utilities._build_simple_context(_model(), MatrixManager.MatrixManager(s, D), _gwas())
+        o = Utilities._build_context(_model(), MatrixManager.MatrixManager(s, D), _gwas())
+        r = AssociationCalculation.association("A", c)
+        assert_equal_tuple(self, r, AssociationCalculation.association("A", o))
+        numpy.testing.assert_allclose(c.provide_calculation("A")[1]["weight"], [0.2, 0.3, 0.4])
+
+        # without a beta column the effect size is undefined, not zero
+        gwas = _gwas().drop(Constants.BETA, axis=1)
+        c = Utilities._build_simple_context(_prediction_model(), MatrixManager.MatrixManager(s, D), gwas)
+        o = Utilities._build_context(_prediction_model(), MatrixManager.MatrixManager(s, D), gwas)
+        r = AssociationCalculation.association("A", c)
+        assert_equal_tuple(self, r, AssociationCalculation.association("A", o))
+        self.assertTrue(numpy.isnan(r[2]))
+
     def test_dataframe_from_results(self):
         results = [
             ('A', 0.42313735862217716, 0.42845528455235105, 0.10250000000002803, 4, 4, 3),
@@ -92,6 +207,18 @@ class TestAssociationCalculation(unittest.TestCase):
         numpy.testing.assert_array_equal(d[A.K_N_SNPS_IN_COV], r_[A.N_SNPS_IN_COV])
         numpy.testing.assert_array_equal(d[A.K_N_SNPS_USED], r_[A.N_SNPS_USED])
 
+    def test_format_output(self):
+        c = _context()
+        results = [AssociationCalculation.association(gene, c) for gene in ["A", "B", "C", "D"]]
+        results = AssociationCalculation.dataframe_from_results(results)
+        r = Utilities.format_output(results, c, False)
+
+        self.assertEqual(list(r.gene), ["B", "A", "C", "D"])
+        numpy.testing.assert_allclose(r.pvalue.values[:3], [0.056897, 0.672195, 0.928287], rtol=1e-5)
+        self.assertTrue(numpy.isnan(r.pvalue.values[3]))
+        self.assertEqual(list(r.n_snps_in_cov[:3]), [6, 4, 2])
+        self.assertTrue(r.n_snps_in_cov.isnull().values[3])
+
 
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file